@@ -1,26 +1,33 @@
 import os
-import json
+import gzip
+import zlib
+import time
+import hashlib
+import functools
+import argparse
+import itertools
+from operator import itemgetter
 from datetime import date, timedelta
 
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from google.cloud import storage, bigquery
+import orjson
+
+from pipeline import (
+    DIRECT_LOAD_MAX_ROWS, _EMPTY, build_service, find_load_job, get_admob_creds,
+    get_bq_client, get_storage_client, in_background, iso_date, require_env,
+    stream_report, submit_load_job, submit_rows_direct, write_ndjson,
+)
 
 # ─── CONFIGURATION & VALIDATION ───────────────────────────────────────────────
-required = {
-    "ADMOB_CLIENT_ID":     os.getenv("ADMOB_CLIENT_ID"),
-    "ADMOB_CLIENT_SECRET": os.getenv("ADMOB_CLIENT_SECRET"),
-    "ADMOB_REFRESH_TOKEN": os.getenv("ADMOB_REFRESH_TOKEN"),
-    "ADMOB_PUBLISHER_ID":  os.getenv("ADMOB_PUBLISHER_ID"),
-    "GCS_BUCKET_NAME":     os.getenv("GCS_BUCKET_NAME"),
-    "GCP_PROJECT":         os.getenv("GCP_PROJECT"),
-    "BQ_DATASET":          os.getenv("BQ_DATASET"),
-    "BQ_TABLE":            os.getenv("BQ_TABLE"),
-}
-missing = [k for k, v in required.items() if not v]
-if missing:
-    raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+required = require_env(
+    "ADMOB_CLIENT_ID",
+    "ADMOB_CLIENT_SECRET",
+    "ADMOB_REFRESH_TOKEN",
+    "ADMOB_PUBLISHER_ID",
+    "GCS_BUCKET_NAME",
+    "GCP_PROJECT",
+    "BQ_DATASET",
+    "BQ_TABLE",
+)
 
 CLIENT_ID      = required["ADMOB_CLIENT_ID"]
 CLIENT_SECRET  = required["ADMOB_CLIENT_SECRET"]
@@ -30,53 +37,69 @@ GCS_BUCKET     = required["GCS_BUCKET_NAME"]
 BQ_PROJECT     = required["GCP_PROJECT"]
 BQ_DATASET     = required["BQ_DATASET"]
 BQ_TABLE       = required["BQ_TABLE"]
-API_SCOPE      = "https://www.googleapis.com/auth/admob.report"
-
-# ─── AUTHENTICATION ────────────────────────────────────────────────────────────
-def get_admob_creds():
-    creds = Credentials(
-        token=None,
-        refresh_token=REFRESH_TOKEN,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        scopes=[API_SCOPE],
-    )
-    creds.refresh(Request())
-    return creds
+REPORT_DAYS    = int(os.getenv("REPORT_DAYS", "1"))
+
+# Names the run's GCS prefix and BigQuery load job. Defaults to the report
+# period, so a retried run reuses the same job id and can't load twice; set
+# it explicitly, or pass --rerun, to load a period again on purpose.
+RUN_ID = os.getenv("ADMOB_RUN_ID")
 
-def build_service(creds):
-    return build("admob", "v1", credentials=creds, cache_discovery=False)
+# Report calls sent per batch request; the API fans them out server-side,
+# so long backfills are split only to keep each batch within quota.
+MAX_BATCH_SIZE = int(os.getenv("ADMOB_MAX_BATCH_SIZE", "50"))
+
+# Optional on-disk cache of raw report responses, so re-running the same
+# (account, date) during a backfill or retry doesn't hit the API again.
+# Unset disables it; cached days are not re-fetched until the entry expires.
+REPORT_CACHE_DIR = os.getenv("ADMOB_REPORT_CACHE_DIR")
+REPORT_CACHE_TTL = timedelta(days=7)
 
 # ─── FETCH MEDIATION REPORT ───────────────────────────────────────────────────
-def fetch_mediation(service, account_name, report_date):
-    dims = [
-        "DATE",
-        "APP", "AD_UNIT",
-        "AD_SOURCE", "AD_SOURCE_INSTANCE", "MEDIATION_GROUP",
-        "COUNTRY",
-    ]
-    mets = [
-        "AD_REQUESTS", "CLICKS", "ESTIMATED_EARNINGS", "IMPRESSIONS",
-        "IMPRESSION_CTR", "MATCHED_REQUESTS", "MATCH_RATE", "OBSERVED_ECPM"
-    ]
-
-    spec = {
+DIMENSIONS = (
+    "DATE",
+    "APP", "AD_UNIT",
+    "AD_SOURCE", "AD_SOURCE_INSTANCE", "MEDIATION_GROUP",
+    "COUNTRY",
+)
+METRICS = (
+    "AD_REQUESTS", "CLICKS", "ESTIMATED_EARNINGS", "IMPRESSIONS",
+    "IMPRESSION_CTR", "MATCHED_REQUESTS", "MATCH_RATE", "OBSERVED_ECPM",
+)
+
+def _metric_dispatch(metric):
+    """Maps each API value kind to the (column, converter) it is written as."""
+    col = metric.lower()
+    micros_col = col + "_micros" if metric in ("ESTIMATED_EARNINGS", "OBSERVED_ECPM") else col
+    return {
+        "integerValue": (col, int),
+        "doubleValue":  (col, float),
+        "microsValue":  (micros_col, int),
+    }
+
+@functools.lru_cache(maxsize=None)
+def _row_plan(dimensions, metrics):
+    """
+    Output column names for a dimension/metric selection, computed once
+    instead of per row. DATE is skipped since parse_rows reformats it.
+    Metrics map to (metric, column used when missing, value-kind dispatch).
+    """
+    dim_pairs = tuple((d, d.lower()) for d in dimensions if d != "DATE")
+    met_keys  = tuple((m, m.lower(), _metric_dispatch(m)) for m in metrics)
+    return dim_pairs, met_keys
+
+def build_spec(report_date, dimensions=DIMENSIONS, metrics=METRICS):
+    return {
         "dateRange": {
             "startDate": {"year": report_date.year, "month": report_date.month, "day": report_date.day},
             "endDate":   {"year": report_date.year, "month": report_date.month, "day": report_date.day},
         },
-        "dimensions":    dims,
-        "metrics":       mets,
+        "dimensions":    list(dimensions),
+        "metrics":       list(metrics),
         "sortConditions":[{"dimension":"DATE","order":"ASCENDING"}]
     }
 
-    response = service.accounts().mediationReport().generate(
-        parent=f"accounts/{account_name}",
-        body={"reportSpec": spec}
-    ).execute()
-
-    rows = []
+def parse_rows(response, dimensions=DIMENSIONS, metrics=METRICS):
+    dim_pairs, met_keys = _row_plan(tuple(dimensions), tuple(metrics))
     for chunk in response:
         row = chunk.get("row")
         if not row:
@@ -84,75 +107,246 @@ def fetch_mediation(service, account_name, report_date):
         dv = row["dimensionValues"]
         mv = row["metricValues"]
 
-        rec = {}
-        # Reformat raw DATE value ("YYYYMMDD") into "YYYY-MM-DD"
-        raw_date = dv.get("DATE", {}).get("value", "")
-        if len(raw_date) == 8 and raw_date.isdigit():
-            rec["date"] = f"{raw_date[0:4]}-{raw_date[4:6]}-{raw_date[6:8]}"
-        else:
-            rec["date"] = raw_date  # fallback
+        rec = {"date": iso_date(dv.get("DATE", _EMPTY).get("value", ""))}
 
         # Other dimensions
-        for d in dims[1:]:  # skip "DATE" since handled
-            rec[d.lower()] = dv.get(d, {}).get("value")
+        for d, col in dim_pairs:
+            rec[col] = dv.get(d, _EMPTY).get("value")
 
         # Metrics with safe defaults
-        for m in mets:
+        for m, default_col, dispatch in met_keys:
             val = mv.get(m)
-            key = m.lower() + ("_micros" if "OBSERVED_ECPM" in m or "ESTIMATED_EARNINGS" in m else "")
-            simple_key = m.lower() if key.endswith("_micros") else m.lower()
             if not val:
-                rec[simple_key] = 0
-            elif "integerValue" in val:
-                rec[simple_key] = int(val["integerValue"])
-            elif "doubleValue" in val:
-                rec[simple_key] = float(val["doubleValue"])
-            elif "microsValue" in val:
-                rec[key] = int(val["microsValue"])
+                rec[default_col] = 0
+                continue
+            # each metric value carries exactly one typed field
+            kind, raw = next(iter(val.items()))
+            target = dispatch.get(kind)
+            if target:
+                col, conv = target
+                rec[col] = conv(raw)
+
+        yield rec
 
-        rows.append(rec)
+def _report_cache_path(account_name, report_date, dimensions, metrics):
+    key = hashlib.blake2b(
+        "|".join([account_name, report_date.isoformat(), ",".join(dimensions), ",".join(metrics)]).encode(),
+        digest_size=16,
+    ).hexdigest()
+    return os.path.join(REPORT_CACHE_DIR, f"{key}.json.gz")
 
-    return rows
+def _read_cached_report(path):
+    try:
+        if time.time() - os.path.getmtime(path) > REPORT_CACHE_TTL.total_seconds():
+            os.remove(path)
+            return None
+        with gzip.open(path, "rb") as f:
+            response = orjson.loads(f.read())
+    except (OSError, EOFError, zlib.error, orjson.JSONDecodeError):
+        # best effort: a truncated or corrupt entry is just a cache miss
+        return None
+    if not isinstance(response, list) or not all(isinstance(c, dict) for c in response):
+        return None
+    return response
+
+def _write_cached_report(path, response):
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=3) as f:
+        f.write(orjson.dumps(response))
+    os.replace(tmp_path, path)
+
+def fetch_mediation(service, jobs, *, creds=None, dimensions=DIMENSIONS, metrics=METRICS):
+    """
+    Generates one mediation report per (account, report_date) in `jobs`,
+    sending them as batch HTTP requests of up to MAX_BATCH_SIZE calls, and
+    returns an iterator over the parsed records. Reports found in the
+    response cache (if enabled) are not requested again.
+
+    When `creds` is given and a single uncached report is needed (the daily
+    run), it is streamed instead and parsed row by row as it downloads.
+    """
+    responses   = {}
+    cache_paths = {}
+    pending     = []
+    for i, (account_name, report_date) in enumerate(jobs):
+        if REPORT_CACHE_DIR:
+            path = _report_cache_path(account_name, report_date, dimensions, metrics)
+            cached = _read_cached_report(path)
+            if cached is not None:
+                responses[str(i)] = cached
+                continue
+            cache_paths[str(i)] = path
+        pending.append((i, account_name, report_date))
+
+    if creds is not None and len(pending) == 1 and not cache_paths:
+        i, account_name, report_date = pending[0]
+        responses[str(i)] = stream_report(
+            creds, f"accounts/{account_name}", "mediation",
+            build_spec(report_date, dimensions, metrics),
+        )
+        pending = []
+
+    def _on_response(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        responses[request_id] = response
+        if request_id in cache_paths:
+            _write_cached_report(cache_paths[request_id], response)
+
+    for start in range(0, len(pending), MAX_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_on_response)
+        for i, account_name, report_date in pending[start:start + MAX_BATCH_SIZE]:
+            batch.add(
+                service.accounts().mediationReport().generate(
+                    parent=f"accounts/{account_name}",
+                    body={"reportSpec": build_spec(report_date, dimensions, metrics)}
+                ),
+                request_id=str(i),
+            )
+        batch.execute()
+
+    return itertools.chain.from_iterable(
+        parse_rows(responses[str(i)], dimensions, metrics) for i in range(len(jobs))
+    )
 
 # ─── GCS UPLOAD & BQ LOAD ───────────────────────────────────────────────────────
-def upload_to_gcs(data_str, filename):
-    client = storage.Client(project=BQ_PROJECT)
-    bucket = client.bucket(GCS_BUCKET)
-    blob = bucket.blob(filename)
-    blob.upload_from_string(data_str, content_type="application/json")
-    print(f"Uploaded gs://{GCS_BUCKET}/{filename}")
-
-def load_to_bq(gcs_uri):
-    client = bigquery.Client(project=BQ_PROJECT)
-    table_ref = client.dataset(BQ_DATASET).table(BQ_TABLE)
+def upload_ndjson_to_gcs(rows, filename):
+    """Streams records to GCS as gzipped NDJSON through a resumable upload."""
+    client = get_storage_client(BQ_PROJECT)
+    blob = client.bucket(GCS_BUCKET).blob(filename)
+    count = write_ndjson(blob, rows, compress=True)
+    print(f"Uploaded {count} rows to gs://{GCS_BUCKET}/{filename}")
 
-    job_config = bigquery.LoadJobConfig(
+def clear_gcs_prefix(prefix):
+    """
+    Deletes every object under `prefix`, so a wildcard load of the prefix only
+    sees objects written by this run.
+    """
+    bucket = get_storage_client(BQ_PROJECT).bucket(GCS_BUCKET)
+    stale  = list(bucket.list_blobs(prefix=prefix))
+    if stale:
+        bucket.delete_blobs(stale)
+        print(f"Deleted {len(stale)} stale objects under gs://{GCS_BUCKET}/{prefix}")
+
+def _load_job_config():
+    from google.cloud import bigquery
+
+    return bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
         write_disposition="WRITE_APPEND",
         # no autodetect: use your existing table schema
     )
 
-    job = client.load_table_from_uri(gcs_uri, table_ref, job_config=job_config)
+def previous_load(job_id):
+    """The load job an earlier run started under `job_id`, or None."""
+    client = get_bq_client(BQ_PROJECT)
+    return find_load_job(client, job_id, client.dataset(BQ_DATASET).table(BQ_TABLE))
+
+def load_to_bq(gcs_uri, job_id=None):
+    client = get_bq_client(BQ_PROJECT)
+    table_ref = client.dataset(BQ_DATASET).table(BQ_TABLE)
+
+    job = submit_load_job(client, job_id, table_ref, lambda jid: client.load_table_from_uri(
+        gcs_uri, table_ref, job_config=_load_job_config(), job_id=jid))
+    job.result()
+    print(f"Loaded {job.output_rows} rows into {BQ_DATASET}.{BQ_TABLE}")
+
+def load_rows_to_bq(rows, job_id=None):
+    """Loads a small batch of records into BigQuery without staging in GCS."""
+    client = get_bq_client(BQ_PROJECT)
+    table_ref = client.dataset(BQ_DATASET).table(BQ_TABLE)
+
+    job = submit_rows_direct(client, rows, table_ref, _load_job_config(), job_id)
     job.result()
     print(f"Loaded {job.output_rows} rows into {BQ_DATASET}.{BQ_TABLE}")
 
 # ─── MAIN ─────────────────────────────────────────────────────────────────────
-def main():
-    creds       = get_admob_creds()
-    service     = build_service(creds)
-    report_date = date.today() - timedelta(days=1)
-
-    rows = fetch_mediation(service, PUBLISHER_ID, report_date)
-    if not rows:
-        print(f"No data returned for {report_date}")
+def main(report_days=REPORT_DAYS, rerun=False):
+    # report_days > 1 backfills the days before yesterday in the same batch
+    last_date    = date.today() - timedelta(days=1)
+    report_dates = [last_date - timedelta(days=n) for n in range(report_days - 1, -1, -1)]
+
+    period = f"{last_date:%Y%m%d}"
+    if len(report_dates) > 1:
+        period = f"{report_dates[0]:%Y%m%d}_{period}"
+    run_id = RUN_ID or period
+    if rerun:
+        # fresh prefix and job id; the period's rows are appended again
+        run_id = f"{run_id}_{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}"
+    job_id = f"mediation_{BQ_DATASET}_{BQ_TABLE}_{run_id}"
+
+    previous = None if rerun else previous_load(job_id)
+    if previous is not None and previous.state != "DONE":
+        # an earlier run's load may still be reading mediation/<run_id>/, so
+        # its objects must not be cleared or rewritten underneath it
+        print(f"Load job {previous.job_id} is still {previous.state}; waiting for it")
+        previous.result()
+        return
+    if previous is not None and previous.error_result is None:
+        print(f"{period} was already loaded by job {previous.job_id}; "
+              f"pass --rerun (or a new ADMOB_RUN_ID) to load it again")
         return
 
-    ndjson   = "\n".join(json.dumps(r) for r in rows)
-    filename = f"mediation_{report_date:%Y%m%d}.jsonl"
-    gcs_uri  = f"gs://{GCS_BUCKET}/{filename}"
+    creds   = get_admob_creds(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
+    service = build_service(creds)
+
+    rows  = fetch_mediation(service, [(PUBLISHER_ID, d) for d in report_dates], creds=creds)
+    head  = list(itertools.islice(rows, DIRECT_LOAD_MAX_ROWS))
+    if not head:
+        print(f"No data returned for {period}")
+        return
+
+    # small reports skip the GCS hop entirely
+    if len(head) < DIRECT_LOAD_MAX_ROWS:
+        load_rows_to_bq(head, job_id)
+        return
+
+    # One object per day under the run's prefix, then a single wildcard load
+    # for the whole period. Rows arrive grouped by day, in date order.
+    # Flatten rows on a worker thread while the main thread compresses/uploads.
+    # The prefix is cleared first (no load job of this run id is running by
+    # now): a retry or a RUN_ID reused for a different period must not leave
+    # other days' objects for the wildcard to pick up.
+    prefix = f"mediation/{run_id}/"
+    rows   = itertools.chain(head, in_background(rows))
+    clear_gcs_prefix(prefix)
+    for day, day_rows in itertools.groupby(rows, key=itemgetter("date")):
+        upload_ndjson_to_gcs(day_rows, f"{prefix}{day}.jsonl.gz")
+    load_to_bq(f"gs://{GCS_BUCKET}/{prefix}*.jsonl.gz", job_id)
+
+def run_profiled(fn, stats_path="fetch_mediation_report.pstats"):
+    """Runs `fn` under cProfile + tracemalloc and reports hot spots and peak memory."""
+    import cProfile
+    import pstats
+    import resource
+    import tracemalloc
 
-    upload_to_gcs(ndjson, filename)
-    load_to_bq(gcs_uri)
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(fn)
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(stats_path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+        max_rss_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"Peak traced Python memory: {peak / 2**20:.1f} MiB, "
+              f"peak RSS: {max_rss_kib / 2**10:.1f} MiB; stats saved to {stats_path}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Export AdMob mediation reports to BigQuery.")
+    parser.add_argument("--days", type=int, default=REPORT_DAYS,
+                        help="number of days up to yesterday to export in one load job")
+    parser.add_argument("--rerun", action="store_true",
+                        help="load the period again under a fresh run id, even if it was "
+                             "already loaded (appends its rows a second time)")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile/tracemalloc and report hot spots")
+    args = parser.parse_args()
+    run = functools.partial(main, args.days, args.rerun)
+    if args.profile:
+        run_profiled(run)
+    else:
+        run()
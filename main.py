@@ -1,121 +1,139 @@
-import os, json
+import itertools
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from google.cloud import storage, bigquery
+from pipeline import (
+    DIRECT_LOAD_MAX_ROWS, get_admob_creds, get_bq_client, get_storage_client,
+    require_env, stream_report, submit_rows_direct, write_ndjson,
+)
 
 # ─── Environment Configuration ────────────────────────────────────────────────
-CLIENT_ID        = os.getenv("ADMOB_CLIENT_ID")
-CLIENT_SECRET    = os.getenv("ADMOB_CLIENT_SECRET")
-REFRESH_TOKEN    = os.getenv("ADMOB_REFRESH_TOKEN")
-
-GCS_BUCKET       = os.getenv("GCS_BUCKET_NAME")
-BQ_PROJECT       = os.getenv("GCP_PROJECT")
-BQ_DATASET       = os.getenv("BQ_DATASET")
-BQ_TABLE         = os.getenv("BQ_TABLE")
-
-API_SCOPE        = "https://www.googleapis.com/auth/admob.report"
-
-def get_admob_creds():
-    """Refreshes and returns OAuth2 credentials for AdMob API calls."""
-    creds = Credentials(
-        token=None,
-        refresh_token=REFRESH_TOKEN,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        scopes=[API_SCOPE],
-    )
-    creds.refresh(Request())  # Correct refresh call :contentReference[oaicite:5]{index=5}:contentReference[oaicite:6]{index=6}
-    return creds
-
-def get_admob_service(creds):
-    """Builds and returns the AdMob API service object."""
-    return build("admob", "v1", credentials=creds, cache_discovery=False)
-
-def get_account_name(service, publisher_id):
-    """Fetches and prints AdMob account info, returns the account resource name."""
-    response = service.accounts().get(name=f"accounts/{publisher_id}").execute()
-    print("Account:", response["name"], "Publisher ID:", response["publisherId"])  # :contentReference[oaicite:7]{index=7}
-    return response["name"]
-
-def fetch_report(service, parent, method, report_spec):
-    """
-    Executes either networkReport.generate or mediationReport.generate
-    and returns the streaming response.
-    """
-    if method == "network":
-        return service.accounts().networkReport().generate(
-            parent=parent, body={"reportSpec": report_spec}
-        ).execute()  # :contentReference[oaicite:8]{index=8}
-    else:
-        return service.accounts().mediationReport().generate(
-            parent=parent, body={"reportSpec": report_spec}
-        ).execute()  # :contentReference[oaicite:9]{index=9}
+required = require_env(
+    "ADMOB_CLIENT_ID",
+    "ADMOB_CLIENT_SECRET",
+    "ADMOB_REFRESH_TOKEN",
+    "ADMOB_PUBLISHER_ID",
+    "GCS_BUCKET_NAME",
+    "GCP_PROJECT",
+    "BQ_DATASET",
+    "BQ_TABLE",
+)
+
+CLIENT_ID        = required["ADMOB_CLIENT_ID"]
+CLIENT_SECRET    = required["ADMOB_CLIENT_SECRET"]
+REFRESH_TOKEN    = required["ADMOB_REFRESH_TOKEN"]
+PUBLISHER_ID     = required["ADMOB_PUBLISHER_ID"].split('/')[-1]  # allow either "pub-123" or "accounts/pub-123"
+
+GCS_BUCKET       = required["GCS_BUCKET_NAME"]
+BQ_PROJECT       = required["GCP_PROJECT"]
+BQ_DATASET       = required["BQ_DATASET"]
+BQ_TABLE         = required["BQ_TABLE"]
+
+# Report columns: (BigQuery column, API key) for dimensions and
+# (BigQuery column, API key, value field, converter) for metrics.
+DIMENSION_COLUMNS = (
+    ("date",               "DATE"),
+    ("month",              "MONTH"),
+    ("week",               "WEEK"),
+    ("ad_source",          "AD_SOURCE"),
+    ("ad_source_instance", "AD_SOURCE_INSTANCE"),
+    ("ad_unit",            "AD_UNIT"),
+    ("app",                "APP"),
+    ("mediation_group",    "MEDIATION_GROUP"),
+    ("country",            "COUNTRY"),
+    ("app_version_name",   "APP_VERSION_NAME"),
+)
+METRIC_COLUMNS = (
+    ("ad_requests",               "AD_REQUESTS",        "integerValue", int),
+    ("clicks",                    "CLICKS",             "integerValue", int),
+    ("estimated_earnings_micros", "ESTIMATED_EARNINGS", "microsValue",  int),
+    ("impressions",               "IMPRESSIONS",        "integerValue", int),
+    ("impression_ctr",            "IMPRESSION_CTR",     "doubleValue",  float),
+    ("impression_rpm_micros",     "IMPRESSION_RPM",     "microsValue",  int),
+    ("match_rate",                "MATCH_RATE",         "doubleValue",  float),
+    ("show_rate",                 "SHOW_RATE",          "doubleValue",  float),
+)
+
+# One C-level call pulls every dimension/metric out of a row
+_DIM_NAMES = tuple(name for name, _ in DIMENSION_COLUMNS)
+_dim_get   = itemgetter(*(key for _, key in DIMENSION_COLUMNS))
+_MET_CASTS = tuple((name, field, cast) for name, _, field, cast in METRIC_COLUMNS)
+_met_get   = itemgetter(*(key for _, key, _, _ in METRIC_COLUMNS))
 
 def parse_rows(stream):
-    """Extracts and returns list of dict records from the API stream."""
-    rows = []
+    """Yields dict records from the API stream."""
     for chunk in stream:
         if "row" not in chunk:
             continue
-        dv = chunk["row"]["dimensionValues"]
-        mv = chunk["row"]["metricValues"]
-        record = {
-            "date": dv["DATE"]["value"],
-            "month": dv["MONTH"]["value"],
-            "week": dv["WEEK"]["value"],
-            "ad_source": dv["AD_SOURCE"]["value"],
-            "ad_source_instance": dv["AD_SOURCE_INSTANCE"]["value"],
-            "ad_unit": dv["AD_UNIT"]["value"],
-            "app": dv["APP"]["value"],
-            "mediation_group": dv["MEDIATION_GROUP"]["value"],
-            "country": dv["COUNTRY"]["value"],
-            "app_version_name": dv["APP_VERSION_NAME"]["value"],
-            "ad_requests": int(mv["AD_REQUESTS"]["integerValue"]),
-            "clicks": int(mv["CLICKS"]["integerValue"]),
-            "estimated_earnings_micros": int(mv["ESTIMATED_EARNINGS"]["microsValue"]),
-            "impressions": int(mv["IMPRESSIONS"]["integerValue"]),
-            "impression_ctr": float(mv["IMPRESSION_CTR"]["doubleValue"]),
-            "impression_rpm_micros": int(mv["IMPRESSION_RPM"]["microsValue"]),
-            "match_rate": float(mv["MATCH_RATE"]["doubleValue"]),
-            "show_rate": float(mv["SHOW_RATE"]["doubleValue"]),
-        }
-        rows.append(record)
-    return rows
+        row = chunk["row"]
+        record = {name: v["value"]
+                  for name, v in zip(_DIM_NAMES, _dim_get(row["dimensionValues"]))}
+        for (name, field, cast), m in zip(_MET_CASTS, _met_get(row["metricValues"])):
+            record[name] = cast(m[field])
+        yield record
 
 def upload_jsonl_to_gcs(records, filename):
-    """Uploads newline-delimited JSON records to GCS."""
-    client = storage.Client()  # :contentReference[oaicite:10]{index=10}
+    """Streams newline-delimited JSON records to GCS, gzipped."""
+    client = get_storage_client(BQ_PROJECT)  # :contentReference[oaicite:10]{index=10}
     blob = client.bucket(GCS_BUCKET).blob(filename)
-    payload = "\n".join(json.dumps(r) for r in records)
-    blob.upload_from_string(payload, content_type="application/json")
-    print(f"Uploaded {len(records)} rows to gs://{GCS_BUCKET}/{filename}")  
+    # only reports too big for a direct load get here, where the repetitive
+    # dimension strings make the upload, not the load, the slow part
+    count = write_ndjson(blob, records, compress=True)
+    print(f"Uploaded {count} rows to gs://{GCS_BUCKET}/{filename}")
 
-def load_jsonl_to_bq(filename):
-    """Appends the JSONL file from GCS into BigQuery."""
-    client = bigquery.Client(project=BQ_PROJECT)
-    table_ref = client.dataset(BQ_DATASET).table(BQ_TABLE)
-    job_config = bigquery.LoadJobConfig(
+def _load_job_config():
+    from google.cloud import bigquery
+
+    return bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
         autodetect=True,
         write_disposition="WRITE_APPEND"
     )  # :contentReference[oaicite:11]{index=11}
+
+def start_jsonl_load(filename):
+    """Starts appending the JSONL file from GCS into BigQuery; returns the load job."""
+    client = get_bq_client(BQ_PROJECT)
+    table_ref = client.dataset(BQ_DATASET).table(BQ_TABLE)
     uri = f"gs://{GCS_BUCKET}/{filename}"
-    job = client.load_table_from_uri(uri, table_ref, job_config=job_config)
-    job.result()
-    print(f"Loaded {job.output_rows} rows into {BQ_DATASET}.{BQ_TABLE}")
+    return client.load_table_from_uri(uri, table_ref, job_config=_load_job_config())
+
+def start_rows_load(records):
+    """Starts appending a small batch of records without staging in GCS; returns the load job."""
+    client = get_bq_client(BQ_PROJECT)
+    table_ref = client.dataset(BQ_DATASET).table(BQ_TABLE)
+    return submit_rows_direct(client, records, table_ref, _load_job_config())
+
+def table_exists():
+    from google.api_core.exceptions import NotFound
+
+    client = get_bq_client(BQ_PROJECT)
+    try:
+        client.get_table(client.dataset(BQ_DATASET).table(BQ_TABLE))
+    except NotFound:
+        return False
+    return True
+
+def export_report(rows, filename):
+    """
+    Sends one report's rows towards BigQuery and returns the running load job
+    (None if the report is empty). Small reports are loaded straight from
+    memory; larger ones are streamed to `filename` in GCS and loaded from there.
+    """
+    head = list(itertools.islice(rows, DIRECT_LOAD_MAX_ROWS))
+    if not head:
+        return None
+    if len(head) < DIRECT_LOAD_MAX_ROWS:
+        return start_rows_load(head)
+    upload_jsonl_to_gcs(itertools.chain(head, rows), filename)
+    return start_jsonl_load(filename)
 
 def main():
     # 1. Authenticate to AdMob
-    creds   = get_admob_creds()
-    service = get_admob_service(creds)
+    creds = get_admob_creds(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
 
-    # 2. Get account resource name
-    PUBLISHER_ID = os.getenv("ADMOB_PUBLISHER_ID")  # e.g. 'pub-123456…'
-    account_name = get_account_name(service, PUBLISHER_ID)
+    # 2. Account resource name, straight from the configured publisher ID
+    account_name = f"accounts/{PUBLISHER_ID}"
 
     # 3. Build a report spec for yesterday’s metrics
     yesterday = date.today() - timedelta(days=1)
@@ -124,34 +142,41 @@ def main():
             "startDate": {"year": yesterday.year,"month": yesterday.month,"day": yesterday.day},
             "endDate":   {"year": yesterday.year,"month": yesterday.month,"day": yesterday.day}
         },
-        "dimensions": [
-            "DATE","MONTH","WEEK","AD_SOURCE","AD_SOURCE_INSTANCE",
-            "AD_UNIT","APP","MEDIATION_GROUP","COUNTRY","APP_VERSION_NAME"
-        ],
-        "metrics": [
-            "AD_REQUESTS","CLICKS","ESTIMATED_EARNINGS","IMPRESSIONS",
-            "IMPRESSION_CTR","IMPRESSION_RPM","MATCH_RATE","SHOW_RATE"
-        ],
+        "dimensions": [key for _, key in DIMENSION_COLUMNS],
+        "metrics":    [key for _, key, _, _ in METRIC_COLUMNS],
         "sortConditions": [{"dimension":"DATE","order":"ASCENDING"}]
     }
 
-    # 4. Fetch & parse network report
-    net_stream = fetch_report(service, account_name, "network", spec)
-    net_rows   = parse_rows(net_stream)
-
-    # 5. Fetch & parse mediation report
-    med_stream = fetch_report(service, account_name, "mediation", spec)
-    med_rows   = parse_rows(med_stream)
-
-    all_rows = net_rows + med_rows
-    if not all_rows:
+    # 4. Stream, upload and submit the network and mediation reports in
+    #    parallel, each to its own blob and load job; rows are parsed as
+    #    they download
+    def export(kind):
+        rows = parse_rows(stream_report(creds, account_name, kind, spec))
+        return export_report(rows, f"admob_{yesterday:%Y%m%d}_{kind}.jsonl.gz")
+
+    kinds = ("network", "mediation")
+    if table_exists():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            jobs = [job for job in executor.map(export, kinds) if job]
+    else:
+        # Both reports append to BQ_TABLE, and the first load creates it from
+        # the autodetected schema. Two concurrent loads would race to create
+        # it, so the first run finishes one load before submitting the next.
+        jobs = []
+        for kind in kinds:
+            job = export(kind)
+            if job:
+                job.result()
+                jobs.append(job)
+
+    if not jobs:
         print("No data for", yesterday)
         return
 
-    # 6. Upload & load
-    filename = f"admob_{yesterday:%Y%m%d}.jsonl"
-    upload_jsonl_to_gcs(all_rows, filename)
-    load_jsonl_to_bq(filename)
+    # 5. Both load jobs run server-side at once; wait for them together
+    for job in jobs:
+        job.result()
+        print(f"Loaded {job.output_rows} rows into {BQ_DATASET}.{BQ_TABLE}")
 
 if __name__ == "__main__":
     main()
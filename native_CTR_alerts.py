@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
+import io
 import os
 import csv
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import date, timedelta, datetime
 
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from google.cloud import bigquery
 
-from google.cloud import storage, bigquery
+from pipeline import (
+    NETWORK_CSV_HEADER, get_admob_creds, get_bq_client, load_network_csv, network_csv_rows,
+    network_report_spec, require_env, stream_report,
+)
 
 # ─── PICK REPORT DATE ──────────────────────────────────────────────────────────
 raw = os.getenv("REPORT_DATE") or os.getenv("INPUT_RUN_DATE")
@@ -18,211 +23,85 @@ else:
     # default to today UTC
     report_date = date.today()
 
-# ─── WHICH APPS TO REPORT ───────────────────────────────────────────────────────
-raw_apps = os.getenv("APPS", "")
-APP_LIST = [line.strip() for line in raw_apps.splitlines() if line.strip()]
-if not APP_LIST:
-    raise RuntimeError("Missing required env var APPS")
+# ─── APPS & AD UNITS (one per line) ────────────────────────────────────────────
+def _env_lines(name: str) -> tuple:
+    """The stripped, non-blank lines of a multi-line env var."""
+    return tuple(filter(None, (line.strip() for line in os.getenv(name, "").splitlines())))
 
-# ─── AD UNIT FILTER ─────────────────────────────────────────────────────────────
-raw_ad_units = os.getenv("AD_UNIT_ID", "")
-ad_unit_ids = [line.strip() for line in raw_ad_units.splitlines() if line.strip()]
+APP_LIST    = _env_lines("APPS")
+ad_unit_ids = _env_lines("AD_UNIT_ID")
 
 # ─── REQUIRED ENV VARS ──────────────────────────────────────────────────────────
-required = {
-    "ADMOB_CLIENT_ID":     os.getenv("ADMOB_CLIENT_ID"),
-    "ADMOB_CLIENT_SECRET": os.getenv("ADMOB_CLIENT_SECRET"),
-    "ADMOB_REFRESH_TOKEN": os.getenv("ADMOB_REFRESH_TOKEN"),
-    "ADMOB_PUBLISHER_ID":  os.getenv("ADMOB_PUBLISHER_ID"),
-    "GCP_PROJECT":         os.getenv("GCP_PROJECT"),
-    "GCS_BUCKET_NAME":     os.getenv("GCS_BUCKET_NAME"),
-    "BQ_DATASET":          os.getenv("BQ_DATASET"),
-    "BQ_TABLE_NETWORK":    os.getenv("BQ_TABLE_NETWORK"),
-    "SLACK_WEBHOOK_URL":   os.getenv("SLACK_WEBHOOK_URL"),
-    "APPS":                raw_apps,
-    "AD_UNIT_ID":          raw_ad_units
-}
-missing = [k for k, v in required.items() if not v]
-if missing:
-    raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+required = require_env(
+    "ADMOB_CLIENT_ID",
+    "ADMOB_CLIENT_SECRET",
+    "ADMOB_REFRESH_TOKEN",
+    "ADMOB_PUBLISHER_ID",
+    "GCP_PROJECT",
+    "BQ_DATASET",
+    "BQ_TABLE_NETWORK",
+    "SLACK_WEBHOOK_URL",
+    APPS=APP_LIST,
+    AD_UNIT_ID=ad_unit_ids,
+)
 
 CLIENT_ID         = required["ADMOB_CLIENT_ID"]
 CLIENT_SECRET     = required["ADMOB_CLIENT_SECRET"]
 REFRESH_TOKEN     = required["ADMOB_REFRESH_TOKEN"]
 PUBLISHER_ID      = required["ADMOB_PUBLISHER_ID"].split('/')[-1]
 PROJECT           = required["GCP_PROJECT"]
-BUCKET_NAME       = required["GCS_BUCKET_NAME"]
 DATASET_NAME      = required["BQ_DATASET"]
 TABLE_NAME        = required["BQ_TABLE_NETWORK"]
 SLACK_WEBHOOK_URL = required["SLACK_WEBHOOK_URL"]
 
-API_SCOPE = "https://www.googleapis.com/auth/admob.report"
-
-# ─── AUTH ───────────────────────────────────────────────────────────────────────
-def get_admob_creds():
-    creds = Credentials(
-        token=None,
-        refresh_token=REFRESH_TOKEN,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        scopes=[API_SCOPE],
-    )
-    creds.refresh(Request())
-    return creds
-
-def build_service(creds):
-    return build("admob", "v1", credentials=creds, cache_discovery=False)
-
-# ─── METRIC/DIMENSION HELPERS ─────────────────────────────────────────────────
-def get_int(mv: dict, key: str) -> int:
-    d = mv.get(key, {}) or {}
-    if d.get("integerValue") is not None:
-        return int(d["integerValue"])
-    if d.get("microsValue") is not None:
-        return int(d["microsValue"])
-    for fld in ("decimalValue", "value"):
-        if d.get(fld) is not None:
-            try:
-                return int(float(d[fld]))
-            except:
-                pass
-    return 0
-
-def get_float(mv: dict, key: str) -> float:
-    d = mv.get(key, {}) or {}
-    if d.get("doubleValue") is not None:
-        return float(d["doubleValue"])
-    for fld in ("decimalValue", "value"):
-        if d.get(fld) is not None:
-            try:
-                return float(d[fld])
-            except:
-                pass
-    return 0.0
-
-def disp(dims: dict, key: str) -> str:
-    dv = dims.get(key, {}) or {}
-    return dv.get("displayLabel") or dv.get("value") or ""
-
 # ─── FETCH & WRITE CSV ─────────────────────────────────────────────────────────
-def fetch_and_write_network_csv(service, publisher_id: str, report_date: date, local_path: str) -> str:
-    spec = {
-        "dateRange": {
-            "startDate": {"year": report_date.year,  "month": report_date.month, "day": report_date.day},
-            "endDate":   {"year": report_date.year,  "month": report_date.month, "day": report_date.day},
-        },
-        "dimensions": ["DATE", "APP", "FORMAT", "AD_UNIT"],
-        "metrics": [
-            "AD_REQUESTS", "CLICKS", "ESTIMATED_EARNINGS", "IMPRESSIONS",
-            "IMPRESSION_CTR", "MATCHED_REQUESTS", "MATCH_RATE", "IMPRESSION_RPM", "SHOW_RATE"
-        ],
-        "sortConditions": [{"dimension": "DATE", "order": "ASCENDING"}],
-        "dimensionFilters": [
-            {
-                "dimension": "APP",
-                "matchesAny": {"values": APP_LIST}
-            }
-        ]
-    }
-
-    response = service.accounts().networkReport().generate(
-        parent=f"accounts/{publisher_id}",
-        body={"reportSpec": spec}
-    ).execute()
-
-    with open(local_path, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            "date", "app_name", "format", "ad_unit_name",
-            "ad_requests", "clicks", "estimated_earnings_micros", "impressions",
-            "impression_ctr", "matched_requests", "match_rate", "impression_rpm", "show_rate"
-        ])
-
-        for chunk in response:
-            row = chunk.get("row")
-            if not row:
-                continue
-            dims = row.get("dimensionValues", {})
-            mets = row.get("metricValues", {})
-
-            raw = dims.get("DATE", {}).get("value", "")
-            iso_date = f"{raw[:4]}-{raw[4:6]}-{raw[6:]}" if len(raw) == 8 else raw
-
-            writer.writerow([
-                iso_date,
-                disp(dims, "APP"),
-                disp(dims, "FORMAT"),
-                disp(dims, "AD_UNIT"),
-                get_int(mets, "AD_REQUESTS"),
-                get_int(mets, "CLICKS"),
-                get_int(mets, "ESTIMATED_EARNINGS"),
-                get_int(mets, "IMPRESSIONS"),
-                get_float(mets, "IMPRESSION_CTR"),
-                get_int(mets, "MATCHED_REQUESTS"),
-                get_float(mets, "MATCH_RATE"),
-                get_float(mets, "IMPRESSION_RPM"),
-                get_float(mets, "SHOW_RATE"),
-            ])
-
-    print(f"Wrote CSV to {local_path}")
-    return local_path
-
-# ─── UPLOAD TO GCS ─────────────────────────────────────────────────────────────
-def upload_to_gcs(local_path: str, bucket_name: str) -> str:
-    client = storage.Client(project=PROJECT)
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(os.path.basename(local_path))
-    blob.upload_from_filename(local_path, content_type="text/csv")
-    uri = f"gs://{bucket_name}/{os.path.basename(local_path)}"
-    print(f"Uploaded {local_path} → {uri}")
-    return uri
-
-# ─── DELETE EXISTING ROWS FOR THE DATE ──────────────────────────────────────────
-def delete_existing_date(client: bigquery.Client, project: str, dataset: str, table: str, report_date: date):
+def fetch_network_csv(creds, publisher_id: str, report_date: date) -> bytes:
     """
-    Deletes any rows in project.dataset.table whose date = report_date
+    Fetches the network report and returns it as CSV bytes, header first.
+    Rows are parsed and written as the response streams in.
     """
-    table_fq = f"`{project}.{dataset}.{table}`"
-    sql = f"""
-      DELETE FROM {table_fq}
-      WHERE date = '{report_date.isoformat()}'
-    """
-    query_job = client.query(sql)
-    query_job.result()
-    print(f"Deleted rows for date = {report_date} from {table_fq}")
-
-# ─── LOAD INTO BQ (WITH DELETE FIRST) ──────────────────────────────────────────
-def load_csv_to_bq(gcs_uri: str, project: str, dataset: str, table: str, report_date: date):
-    client = bigquery.Client(project=project)
-
-    delete_existing_date(client, project, dataset, table, report_date)
-
-    table_ref = client.dataset(dataset).table(table)
-    job_config = bigquery.LoadJobConfig(
-        source_format       = bigquery.SourceFormat.CSV,
-        skip_leading_rows   = 1,
-        autodetect          = False,
-        write_disposition   = bigquery.WriteDisposition.WRITE_APPEND,
-        create_disposition  = bigquery.CreateDisposition.CREATE_IF_NEEDED,
+    spec     = network_report_spec(APP_LIST, report_date)
+    response = stream_report(creds, f"accounts/{publisher_id}", "network", spec)
+
+    buf = io.StringIO(newline="")
+    writer = csv.writer(buf)
+    writer.writerow(NETWORK_CSV_HEADER)
+    writer.writerows(network_csv_rows(response))
+    return buf.getvalue().encode()
+
+# ─── SLACK ─────────────────────────────────────────────────────────────────────
+# One keep-alive session for every post. Only rate limiting is retried,
+# after the Retry-After Slack sends: a 429 never delivered the message,
+# while a 5xx may have, and the webhook POST isn't idempotent.
+SLACK = requests.Session()
+SLACK.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429],
+    allowed_methods=["POST"],
+    respect_retry_after_header=True,
+    raise_on_status=False,  # leave the final status to the caller's check
+)))
+
+def post_to_slack(webhook_url: str, payload: dict) -> requests.Response:
+    return SLACK.post(
+        webhook_url,
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=10,
     )
 
-    load_job = client.load_table_from_uri(gcs_uri, table_ref, job_config=job_config)
-    load_job.result()
-    print(f"Appended data into {project}.{dataset}.{table} for date {report_date}")
-
 # ─── NATIVE CTR SPIKE ALERT ─────────────────────────────────────────────────────
-def check_native_ctr_alert(project: str, dataset: str, table: str, report_date: date, webhook_url: str, ad_units: list):
+def check_native_ctr_alert(client: bigquery.Client, project: str, dataset: str, table: str, report_date: date, webhook_url: str, ad_units: tuple):
     """
     Queries BQ for any ad_unit_name in ad_units whose impression_ctr on report_date
     differs by more than 25% from its trailing 7-day average (clicks/impressions).
     Sends a Slack alert grouped by app_name. If no anomalies, reports them.
     """
-    client = bigquery.Client(project=project)
     table_fq = f"`{project}.{dataset}.{table}`"
 
-    placeholder_list = ", ".join(f"'{au}'" for au in ad_units)
-
+    # One scan: every ad unit seen today, flagged if it is an anomaly, so the
+    # "no anomalies" message needs no second query for its labels.
     sql = f"""
     WITH
       last7 AS (
@@ -232,10 +111,10 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
           SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS avg_ctr_7d
         FROM {table_fq}
         WHERE
-          ad_unit_name IN ({placeholder_list})
+          ad_unit_name IN UNNEST(@ad_units)
           AND date BETWEEN
-            DATE_SUB('{report_date.isoformat()}', INTERVAL 7 DAY)
-            AND DATE_SUB('{report_date.isoformat()}', INTERVAL 1 DAY)
+            DATE_SUB(@report_date, INTERVAL 7 DAY)
+            AND DATE_SUB(@report_date, INTERVAL 1 DAY)
         GROUP BY
           app_name, ad_unit_name
       ),
@@ -246,8 +125,8 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
           impression_ctr AS today_ctr
         FROM {table_fq}
         WHERE
-          ad_unit_name IN ({placeholder_list})
-          AND date = '{report_date.isoformat()}'
+          ad_unit_name IN UNNEST(@ad_units)
+          AND date = @report_date
       )
     SELECT
       t.app_name,
@@ -256,22 +135,29 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
       ROUND(t.today_ctr, 4)  AS today_ctr,
       ROUND(
         SAFE_DIVIDE(t.today_ctr - l.avg_ctr_7d, l.avg_ctr_7d) * 100
-      , 2)                    AS pct_change
+      , 2)                    AS pct_change,
+      IFNULL(
+        ABS(SAFE_DIVIDE(t.today_ctr - l.avg_ctr_7d, l.avg_ctr_7d) * 100) > 25
+      , FALSE)                AS is_anomaly
     FROM today AS t
-    JOIN last7 AS l
+    LEFT JOIN last7 AS l
       ON t.ad_unit_name = l.ad_unit_name
-    WHERE
-      ABS(
-        SAFE_DIVIDE(t.today_ctr - l.avg_ctr_7d, l.avg_ctr_7d) * 100
-      ) > 25
     ORDER BY pct_change DESC;
     """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("report_date", "DATE", report_date),
+        bigquery.ArrayQueryParameter("ad_units", "STRING", list(ad_units)),
+    ])
 
-    query_job = client.query(sql)
+    query_job = client.query(sql, job_config=job_config)
     results = query_job.result()
 
     alerts_by_app = {}
+    seen_units = {}
     for row in results:
+        seen_units[row.ad_unit_name] = None
+        if not row.is_anomaly:
+            continue
         app = row.app_name
         ad_unit = row.ad_unit_name
         avg_ctr = row.avg_ctr_7d
@@ -282,23 +168,11 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
         alerts_by_app.setdefault(app, []).append(line)
 
     if not alerts_by_app:
-        # No anomalies: fetch each ad_unit_name’s display label for today (or fallback to ID)
-        placeholder_ids = ", ".join(f"'{au}'" for au in ad_units)
-        sql_labels = f"""
-        SELECT
-          DISTINCT ad_unit_name
-        FROM {table_fq}
-        WHERE
-          ad_unit_name IN ({placeholder_ids})
-          AND date = '{report_date.isoformat()}'
-        """
-        label_job = client.query(sql_labels)
-        label_rows = label_job.result()
-
-        display_list = [row.ad_unit_name for row in label_rows]
+        # No anomalies: list each ad_unit_name seen today (or fallback to ID)
+        display_list = list(seen_units)
         # if some IDs had no matching row, include them as-is
         for au in ad_units:
-            if au not in display_list:
+            if au not in seen_units:
                 display_list.append(au)
 
         text = (
@@ -307,7 +181,7 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
             + "\n".join(f"• {label}" for label in display_list)
         )
         payload = {"text": text}
-        resp = requests.post(webhook_url, json=payload, timeout=10)
+        resp = post_to_slack(webhook_url, payload)
         if resp.status_code != 200:
             print(f"Failed to post to Slack (status {resp.status_code}): {resp.text}")
         else:
@@ -322,7 +196,7 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
     text = "\n".join(sections)
 
     payload = {"text": text}
-    resp = requests.post(webhook_url, json=payload, timeout=10)
+    resp = post_to_slack(webhook_url, payload)
     if resp.status_code != 200:
         print(f"Failed to post to Slack (status {resp.status_code}): {resp.text}")
     else:
@@ -330,16 +204,17 @@ def check_native_ctr_alert(project: str, dataset: str, table: str, report_date:
 
 # ─── MAIN ───────────────────────────────────────────────────────────────────────
 def main():
-    creds   = get_admob_creds()
-    service = build_service(creds)
+    creds = get_admob_creds(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
+
+    # one BigQuery client for the load, any delete, and the alert query
+    bq_client = get_bq_client(PROJECT)
 
-    local_csv = f"network_{report_date:%Y%m%d}.csv"
-    fetch_and_write_network_csv(service, PUBLISHER_ID, report_date, local_csv)
-    gcs_uri = upload_to_gcs(local_csv, BUCKET_NAME)
-    load_csv_to_bq(gcs_uri, PROJECT, DATASET_NAME, TABLE_NAME, report_date)
+    csv_bytes = fetch_network_csv(creds, PUBLISHER_ID, report_date)
+    load_network_csv(bq_client, io.BytesIO(csv_bytes),
+                     bq_client.dataset(DATASET_NAME).table(TABLE_NAME), report_date)
 
     check_native_ctr_alert(
-        PROJECT, DATASET_NAME, TABLE_NAME,
+        bq_client, PROJECT, DATASET_NAME, TABLE_NAME,
         report_date, SLACK_WEBHOOK_URL,
         ad_unit_ids
     )
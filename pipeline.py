@@ -0,0 +1,590 @@
+"""
+Helpers shared by the AdMob → GCS → BigQuery scripts.
+
+Nothing here reads required configuration at import time; each script
+validates its own environment and passes values in.
+"""
+import io
+import os
+import csv
+import gzip
+import json
+import fcntl
+import queue
+import hashlib
+import functools
+import itertools
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+
+import ijson
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.api_core.exceptions import Conflict, NotFound
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request
+
+API_SCOPE = "https://www.googleapis.com/auth/admob.report"
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+ADMOB_API_ROOT = "https://admob.googleapis.com/v1"
+
+# Seconds per socket operation on the discovery client's transport, and
+# (connect, read) seconds for streamed report requests.
+API_TIMEOUT    = 60
+REPORT_TIMEOUT = (10, 300)
+
+# Streamed report requests are retried with exponential backoff on connection
+# errors, rate limiting and server errors. generate only reads, so retrying
+# the POST is safe.
+REPORT_RETRY = Retry(
+    total=5,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["POST"],
+    raise_on_status=False,  # let raise_for_status report the final response
+)
+
+# Access tokens live ~1h; reuse a cached one until shortly before it expires.
+TOKEN_CACHE_PATH     = os.path.expanduser(os.getenv("ADMOB_TOKEN_CACHE", "~/.cache/admob_token.json"))
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# Resumable-upload chunk size; must be a multiple of 256 KiB.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Reports with fewer rows than this are loaded into BigQuery straight from
+# memory; larger ones are staged in GCS first.
+DIRECT_LOAD_MAX_ROWS = int(os.getenv("BQ_DIRECT_LOAD_MAX_ROWS", "10000"))
+
+# ─── CONFIGURATION ────────────────────────────────────────────────────────────
+def require_env(*names, **values):
+    """
+    Reads the environment variables `names`, plus any already-parsed
+    `values`, into one dict, raising a RuntimeError that lists every one
+    that is missing or empty.
+    """
+    required = {name: os.getenv(name) for name in names}
+    required.update(values)
+    missing = [k for k, v in required.items() if not v]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+    return required
+
+# ─── AUTHENTICATION ───────────────────────────────────────────────────────────
+def _utcnow():
+    # google-auth compares expiry as a naive UTC datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _token_cache_key(refresh_token):
+    # one entry per refresh token, so several accounts can share the file
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+@contextmanager
+def _token_cache_lock():
+    # exclusive lock so concurrent runs don't all refresh at once
+    os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+    with open(TOKEN_CACHE_PATH + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _load_token_cache():
+    try:
+        with open(TOKEN_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _read_cached_token(refresh_token):
+    entry = _load_token_cache().get(_token_cache_key(refresh_token))
+    if not entry:
+        return None, None
+    return entry["token"], datetime.fromisoformat(entry["expiry"])
+
+def _write_cached_token(creds):
+    cache = _load_token_cache()
+    cache[_token_cache_key(creds.refresh_token)] = {
+        "token": creds.token,
+        "expiry": creds.expiry.isoformat(),
+    }
+    tmp_path = f"{TOKEN_CACHE_PATH}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, TOKEN_CACHE_PATH)
+
+def _needs_refresh(creds):
+    return not creds.token or not creds.expiry or creds.expiry - _utcnow() <= TOKEN_REFRESH_MARGIN
+
+def get_admob_creds(client_id, client_secret, refresh_token):
+    """
+    Returns AdMob OAuth2 credentials, reusing the access token cached by an
+    earlier run while it is valid for more than TOKEN_REFRESH_MARGIN.
+    """
+    with _token_cache_lock():
+        token, expiry = _read_cached_token(refresh_token)
+        creds = Credentials(
+            token=token,
+            expiry=expiry,
+            refresh_token=refresh_token,
+            token_uri=TOKEN_URI,
+            client_id=client_id,
+            client_secret=client_secret,
+            scopes=[API_SCOPE],
+        )
+        if _needs_refresh(creds):
+            creds.refresh(Request())
+            _write_cached_token(creds)
+    return creds
+
+# ─── ADMOB SERVICE ────────────────────────────────────────────────────────────
+# googleapiclient and httplib2 are imported only when a discovery service is
+# built; the streamed report fetches every script uses don't need them.
+@functools.lru_cache(maxsize=None)
+def _orjson_model_class():
+    from googleapiclient.model import JsonModel
+
+    class OrjsonModel(JsonModel):
+        """JsonModel that decodes response bodies with orjson instead of stdlib json."""
+
+        def deserialize(self, content):
+            try:
+                body = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                # e.g. an HTML error page from a proxy; the base class
+                # returns the raw content for the caller's HttpError
+                return super().deserialize(content)
+            if self._data_wrapper and isinstance(body, dict) and "data" in body:
+                body = body["data"]
+            return body
+
+    return OrjsonModel
+
+def build_service(creds):
+    """
+    Builds the AdMob service on one explicit keep-alive transport, so every
+    request made through it (batches included) reuses the same connection.
+    Like the service itself, the transport is not thread-safe; build one
+    per thread.
+    """
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=API_TIMEOUT))
+    return build("admob", "v1", http=http, model=_orjson_model_class()(), cache_discovery=False)
+
+def stream_report(creds, parent, kind, spec):
+    """
+    Runs accounts.{kind}Report.generate ("network" or "mediation") for
+    `parent` over a streamed HTTP response and yields its header/row/footer
+    chunks as they are parsed, rather than decoding the whole response
+    before the first row is available.
+    """
+    url = f"{ADMOB_API_ROOT}/{parent}/{kind}Report:generate"
+    with AuthorizedSession(creds) as session:
+        session.mount("https://", HTTPAdapter(max_retries=REPORT_RETRY))
+        with session.post(url, json={"reportSpec": spec}, stream=True,
+                          timeout=REPORT_TIMEOUT) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            yield from ijson.items(resp.raw, "item", use_float=True)
+
+_DONE = object()
+
+def in_background(iterable, maxsize=1024):
+    """
+    Consumes `iterable` on a worker thread and yields its items through a
+    bounded queue (unbounded if `maxsize` is 0), so producing rows overlaps
+    with whatever the caller does with them. The worker starts immediately,
+    not on first iteration. Exceptions from the worker are re-raised in the
+    caller.
+    """
+    items  = queue.Queue(maxsize)
+    errors = []
+
+    def _produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            items.put(_DONE)
+
+    threading.Thread(target=_produce, daemon=True).start()
+    return _drain(items, errors)
+
+def _drain(items, errors):
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        yield item
+    if errors:
+        raise errors[0]
+
+# ─── REPORT VALUES ─────────────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=None)
+def iso_date(raw):
+    """
+    Reformats an API DATE value ("YYYYMMDD") as "YYYY-MM-DD", passing anything
+    else through. Cached: every row of a report shares a handful of dates.
+    """
+    return f"{raw[:4]}-{raw[4:6]}-{raw[6:]}" if len(raw) == 8 else raw
+
+_EMPTY = {}  # shared default for missing values; never mutated
+
+def get_int(mv: dict, key: str) -> int:
+    """Integer metric `key` from a row's metricValues, defaulting to 0."""
+    d = mv.get(key) or _EMPTY
+    if d.get("integerValue") is not None:
+        return int(d["integerValue"])
+    if d.get("microsValue") is not None:
+        return int(d["microsValue"])
+    for fld in ("decimalValue", "value"):
+        if d.get(fld) is not None:
+            try:
+                return int(float(d[fld]))
+            except ValueError:
+                pass
+    return 0
+
+def get_float(mv: dict, key: str) -> float:
+    """Float metric `key` from a row's metricValues, defaulting to 0.0."""
+    d = mv.get(key) or _EMPTY
+    if d.get("doubleValue") is not None:
+        return float(d["doubleValue"])
+    for fld in ("decimalValue", "value"):
+        if d.get(fld) is not None:
+            try:
+                return float(d[fld])
+            except ValueError:
+                pass
+    return 0.0
+
+def disp(dims: dict, key: str) -> str:
+    """Dimension's displayLabel if present, else its raw value."""
+    dv = dims.get(key) or _EMPTY
+    return dv.get("displayLabel") or dv.get("value") or ""
+
+def raw_value(dims: dict, key: str) -> str:
+    """Dimension's raw value (e.g. the country code, not its name)."""
+    return (dims.get(key) or _EMPTY).get("value") or ""
+
+def metric_extractor(key: str, field: str, getter):
+    """
+    Returns a function reading metric `key` for a CSV row straight from the
+    typed field the API uses for it, falling back to `getter` (get_int or
+    get_float) only when that field is missing. The value is passed through
+    as sent (digit strings for integer and micros fields), since the csv
+    writer would only turn a parsed number back into the same text and
+    BigQuery parses it on load anyway.
+    """
+    def extract(mets: dict):
+        # the typed field is almost always there, so try it first and pay
+        # for the fallback only when it isn't
+        try:
+            value = mets[key][field]
+        except (KeyError, TypeError):
+            return getter(mets, key)
+        return getter(mets, key) if value is None else value
+    return extract
+
+# ─── NETWORK REPORT ────────────────────────────────────────────────────────────
+# CSV columns after "date": (column, API key) for dimensions and
+# (column, API key, value field, getter) for metrics, in output order.
+# Shared by every script that exports the network report, so their CSVs and
+# tables keep the same layout.
+NETWORK_CSV_DIMENSIONS = (
+    ("app_name",     "APP"),
+    ("format",       "FORMAT"),
+    ("ad_unit_name", "AD_UNIT"),
+)
+NETWORK_CSV_METRICS = (
+    ("ad_requests",               "AD_REQUESTS",        "integerValue", get_int),
+    ("clicks",                    "CLICKS",             "integerValue", get_int),
+    ("estimated_earnings_micros", "ESTIMATED_EARNINGS", "microsValue",  get_int),
+    ("impressions",               "IMPRESSIONS",        "integerValue", get_int),
+    ("impression_ctr",            "IMPRESSION_CTR",     "doubleValue",  get_float),
+    ("matched_requests",          "MATCHED_REQUESTS",   "integerValue", get_int),
+    ("match_rate",                "MATCH_RATE",         "doubleValue",  get_float),
+    ("impression_rpm",            "IMPRESSION_RPM",     "doubleValue",  get_float),
+    ("show_rate",                 "SHOW_RATE",          "doubleValue",  get_float),
+)
+NETWORK_CSV_HEADER = (["date"] + [c for c, _ in NETWORK_CSV_DIMENSIONS]
+                      + [c for c, _, _, _ in NETWORK_CSV_METRICS])
+
+_NETWORK_DIM_KEYS       = tuple(k for _, k in NETWORK_CSV_DIMENSIONS)
+_NETWORK_MET_KEYS       = tuple(k for _, k, _, _ in NETWORK_CSV_METRICS)
+_NETWORK_MET_EXTRACTORS = tuple(metric_extractor(k, f, get) for _, k, f, get in NETWORK_CSV_METRICS)
+
+def network_csv_rows(response):
+    """Yields one CSV row (list) per network report row, for csv.writer.writerows."""
+    for chunk in response:
+        row = chunk.get("row")
+        if not row:
+            continue
+        dims = row.get("dimensionValues") or _EMPTY
+        mets = row.get("metricValues") or _EMPTY
+
+        out = [iso_date((dims.get("DATE") or _EMPTY).get("value", ""))]
+        out += [disp(dims, k) for k in _NETWORK_DIM_KEYS]
+        out += [extract(mets) for extract in _NETWORK_MET_EXTRACTORS]
+        yield out
+
+def network_report_spec(apps, report_date):
+    """
+    The network report request for `apps` on `report_date`, derived from the
+    column tables so the requested fields always match NETWORK_CSV_HEADER.
+    """
+    day = {"year": report_date.year, "month": report_date.month, "day": report_date.day}
+    return {
+        "dateRange": {"startDate": day, "endDate": day},
+        "dimensions": ["DATE", *_NETWORK_DIM_KEYS],
+        "metrics":    list(_NETWORK_MET_KEYS),
+        "sortConditions": [{"dimension": "DATE", "order": "ASCENDING"}],
+        "dimensionFilters": [
+            {
+                "dimension": "APP",
+                "matchesAny": {"values": list(apps)}
+            }
+        ]
+    }
+
+# ─── GCS / BIGQUERY CLIENTS ───────────────────────────────────────────────────
+# One client of each per project and process, so credential discovery and the
+# HTTP connection pool are shared between the upload and the load job. The
+# google.cloud imports are deferred so fetch-only callers skip their cost.
+@functools.lru_cache(maxsize=None)
+def get_storage_client(project):
+    from google.cloud import storage
+    return storage.Client(project=project)
+
+@functools.lru_cache(maxsize=None)
+def get_bq_client(project):
+    from google.cloud import bigquery
+    return bigquery.Client(project=project)
+
+# ─── GCS UPLOAD & BQ LOAD ─────────────────────────────────────────────────────
+class _SpooledUpload(io.RawIOBase):
+    """
+    Write-only sink for open_upload. Holds the first UPLOAD_CHUNK_SIZE bytes in
+    memory: an object that never grows past that is sent on commit() as one
+    single-request upload, skipping the resumable session's extra round trip.
+    Larger objects switch to a resumable upload as soon as they cross it.
+    Closing without commit() (or garbage collection) uploads nothing.
+    """
+
+    def __init__(self, blob, content_type):
+        super().__init__()
+        self._blob = blob
+        self._content_type = content_type
+        self._spool = io.BytesIO()
+        self._writer = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._writer is not None:
+            return self._writer.write(data)
+        n = self._spool.write(data)
+        if self._spool.tell() >= UPLOAD_CHUNK_SIZE:
+            self._writer = self._blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, ignore_flush=True,
+                                           content_type=self._content_type)
+            self._writer.write(self._spool.getvalue())
+            self._spool = None
+        return n
+
+    def commit(self):
+        """Finishes the upload, then closes the sink."""
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            self._blob.upload_from_string(self._spool.getvalue(), content_type=self._content_type)
+        self.close()
+
+@contextmanager
+def open_upload(blob, content_type, compress=False):
+    """
+    Opens `blob` for streaming writes and yields a binary file object. Only
+    one chunk is held in memory at a time, and the object is committed only
+    if the block exits cleanly.
+    """
+    # No Content-Encoding on gzipped objects: BigQuery detects and reads the
+    # gzip stream as stored. Level 1 keeps compression cost close to a memcpy.
+    if compress:
+        content_type = "application/gzip"
+    sink = _SpooledUpload(blob, content_type)
+    with (gzip.GzipFile(fileobj=sink, mode="wb", compresslevel=1) if compress
+          else nullcontext(sink)) as fp:
+        yield fp
+    sink.commit()
+
+def write_ndjson(blob, rows, compress=False):
+    """
+    Streams records into `blob` as NDJSON. Returns the number of rows written.
+    """
+    count = 0
+    with open_upload(blob, "application/json", compress) as fp:
+        for r in rows:
+            fp.write(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE))
+            count += 1
+    return count
+
+def write_csv(blob, header, rows, compress=True):
+    """
+    Streams `header` and then `rows` (lists) into `blob` as CSV, gzipped by
+    default.
+    """
+    with open_upload(blob, "text/csv", compress) as fp:
+        text = io.TextIOWrapper(fp, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(header)
+        writer.writerows(rows)
+        text.detach()  # flushes; open_upload closes the stream
+
+def _job_location(client, table_ref):
+    # jobs.get needs the job's location outside the US/EU multi-regions
+    return client.get_dataset(f"{table_ref.project}.{table_ref.dataset_id}").location
+
+def find_load_job(client, job_id, table_ref):
+    """
+    Returns the latest load job submit_load_job started under `job_id`
+    (following its suffixed resubmissions), or None if there is none.
+    """
+    location = _job_location(client, table_ref)
+    attempt_id, job = job_id, None
+    for attempt in itertools.count(1):
+        try:
+            job = client.get_job(attempt_id, location=location)
+        except NotFound:
+            return job
+        attempt_id = f"{job_id}_retry{attempt}"
+
+def submit_load_job(client, job_id, table_ref, submit):
+    """
+    Calls `submit(job_id)` to start a load job into `table_ref` and returns it
+    without waiting. If a job with that id already exists (a retry of a run
+    that got as far as loading), returns the existing job instead of
+    appending the same data a second time, unless that job failed: then the
+    load is submitted again under a suffixed id.
+    """
+    attempt_id = job_id
+    location   = None
+    for attempt in itertools.count(1):
+        try:
+            return submit(attempt_id)
+        except Conflict:
+            pass
+        if location is None:
+            location = _job_location(client, table_ref)
+        existing = client.get_job(attempt_id, location=location)
+        if existing.state != "DONE" or existing.error_result is None:
+            print(f"Load job {attempt_id} already exists; not loading again")
+            return existing
+        print(f"Load job {attempt_id} failed ({existing.error_result.get('message')}); submitting again")
+        attempt_id = f"{job_id}_retry{attempt}"
+
+def submit_rows_direct(client, rows, table_ref, job_config, job_id=None):
+    """
+    Starts loading a small list of records into BigQuery as a single
+    multipart upload, skipping the GCS write and the load job's read back
+    from GCS. Returns the running load job.
+    """
+    payload = b"".join(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in rows)
+    return submit_load_job(client, job_id, table_ref, lambda jid: client.load_table_from_file(
+        io.BytesIO(payload), table_ref, job_config=job_config, job_id=jid))
+
+def is_partitioned_by_date(table):
+    """True if the BigQuery table is day-partitioned on its `date` column."""
+    tp = table.time_partitioning
+    return tp is not None and tp.field == "date" and tp.type_ == "DAY"
+
+# Network tables are created day-partitioned on date and clustered by app/ad
+# unit, so the per-day load and queries filtered on ad_unit_name touch only
+# the blocks they need.
+NETWORK_CLUSTERING_FIELDS = ["app_name", "ad_unit_name"]
+
+def ensure_network_table(client, table_ref):
+    """Returns the network table, first creating it partitioned and clustered if it doesn't exist."""
+    from google.cloud import bigquery
+
+    try:
+        return client.get_table(table_ref)
+    except NotFound:
+        schema = (
+            [bigquery.SchemaField("date", "DATE")]
+            + [bigquery.SchemaField(c, "STRING") for c, _ in NETWORK_CSV_DIMENSIONS]
+            + [bigquery.SchemaField(c, "INTEGER" if get is get_int else "FLOAT")
+               for c, _, _, get in NETWORK_CSV_METRICS]
+        )
+        table = bigquery.Table(table_ref, schema=schema)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field="date")
+        table.clustering_fields = NETWORK_CLUSTERING_FIELDS
+        print(f"Creating {table_ref.path} partitioned by date, clustered by {', '.join(NETWORK_CLUSTERING_FIELDS)}")
+        return client.create_table(table, exists_ok=True)
+
+def replace_date_from_staging(client, target, staging_ref, report_date):
+    """
+    Replaces target's rows for report_date with the staging table's rows in
+    one transaction, so an interrupted run never leaves the day missing.
+    """
+    from google.cloud import bigquery
+
+    target_fq  = f"`{target.project}.{target.dataset_id}.{target.table_id}`"
+    staging_fq = f"`{staging_ref.project}.{staging_ref.dataset_id}.{staging_ref.table_id}`"
+    sql = f"""
+      BEGIN TRANSACTION;
+      DELETE FROM {target_fq} WHERE date = @report_date;
+      INSERT INTO {target_fq} SELECT * FROM {staging_fq};
+      COMMIT TRANSACTION;
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("report_date", "DATE", report_date),
+    ])
+    client.query(sql, job_config=job_config).result()
+    print(f"Replaced rows for date = {report_date} in {target_fq}")
+
+def load_network_csv(client, source, table_ref, report_date):
+    """
+    Loads a network report CSV (header first) into `table_ref`, replacing
+    whatever was already loaded for report_date. `source` is either a gs://
+    URI or a binary file object. The table is created if it doesn't exist.
+    """
+    from google.cloud import bigquery
+
+    target = ensure_network_table(client, table_ref)
+    table_fq = f"{target.project}.{target.dataset_id}.{target.table_id}"
+
+    def load(destination):
+        if isinstance(source, str):
+            job = client.load_table_from_uri(source, destination, job_config=job_config)
+        else:
+            job = client.load_table_from_file(source, destination, job_config=job_config)
+        job.result()
+
+    job_config = bigquery.LoadJobConfig(
+        source_format       = bigquery.SourceFormat.CSV,
+        skip_leading_rows   = 1,
+        autodetect          = False,
+        create_disposition  = bigquery.CreateDisposition.CREATE_IF_NEEDED,
+        write_disposition   = bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+    if is_partitioned_by_date(target):
+        # Overwrite just this day's partition: a single atomic load job, no DML
+        load(f"{table_fq}${report_date:%Y%m%d}")
+        print(f"Loaded data into {table_fq} for date {report_date}")
+        return
+
+    # Legacy unpartitioned table (recreate it to get the path above): stage
+    # the day's rows, then swap them in transactionally.
+    staging_ref = bigquery.TableReference.from_string(f"{table_fq}__staging_{report_date:%Y%m%d}")
+    job_config.schema = target.schema
+    try:
+        load(staging_ref)
+        replace_date_from_staging(client, target, staging_ref, report_date)
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)